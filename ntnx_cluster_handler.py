@@ -7,32 +7,109 @@
 #
 ############################################################
 
-import pprint
-import json
+import atexit
+import io
 import requests
+import urllib3
 import os
+import queue
+import sys
+import threading
+from operator import itemgetter
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import InsecureRequestWarning
+from urllib3.util.retry import Retry
+
+# JSON codec: orjson if available, then ujson, then the standard library.
+# _dumps always returns UTF-8 bytes so callers can write/post it as is.
+try:
+    import orjson
+
+    _loads = orjson.loads
+
+    def _dumps(obj, indent=False):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+except ImportError:
+    try:
+        import ujson as _json
+    except ImportError:
+        import json as _json
+
+    _loads = _json.loads
+
+    def _dumps(obj, indent=False):
+        if indent:
+            return _json.dumps(obj, indent=2).encode("utf-8")
+        return _json.dumps(obj).encode("utf-8")
+
 
 V2_BASE_URL = "https://{}:9440/PrismGateway/services/rest/v2.0/"
+V2_ENDPOINTS = ("cluster", "storage_containers", "networks", "vms")
 POST = "post"
 GET = "get"
 DEBUG = True
 NO_CONN = True
 DATA_PATH = "./data"
 DEBUG_PATH = "./debug"
-DISK_TYPE = ["SCSI", "IDE", "PCI"]
-pp = pprint.PrettyPrinter(indent=2)
+DISK_TYPES = frozenset(("SCSI", "IDE", "PCI"))
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 10
+DEBUG_BUFFER_SIZE = 1 << 20
+DEBUG_JOIN_TIMEOUT = 5
+
+# Background DEBUG dump worker, started by debug_json() on the first dump
+_debug_q = None
+_debug_thread = None
+
+
+def _yn(prompt):
+    return input(prompt).strip().upper() == "Y"
 
 
 def input_json(fname):
     fpath = os.path.join(DATA_PATH, fname)
-    with open(fpath, "rt") as fin:
-        return json.load(fin)
+    with open(fpath, "rb") as fin:
+        return _loads(fin.read())
 
 
 def output_json(json_obj, fname):
     fpath = os.path.join(DEBUG_PATH, fname)
-    with open(fpath, "wt") as fout:
-        json.dump(json_obj, fout, indent=2)
+    tmp_fpath = fpath + ".tmp"
+    data = _dumps(json_obj, indent=True)
+    with open(tmp_fpath, "wb", buffering=DEBUG_BUFFER_SIZE) as fout:
+        fout.write(data)
+    # Atomic swap, so readers never see a partially written dump
+    os.replace(tmp_fpath, fpath)
+
+
+def _debug_worker():
+    while True:
+        item = _debug_q.get()
+        if item is None:
+            break
+        try:
+            output_json(*item)
+        except Exception as ex:
+            # Keep the worker alive so one bad payload does not disable later dumps
+            print(ex, file=sys.stderr)
+
+
+def _stop_debug_worker():
+    # Give queued dumps a bounded time to finish; a stuck write is abandoned with the daemon thread
+    _debug_q.put(None)
+    _debug_thread.join(timeout=DEBUG_JOIN_TIMEOUT)
+
+
+def debug_json(json_obj, fname):
+    # Debug dumps are written by a background worker, off the menu's critical path.
+    # The worker is started on the first dump, so nothing runs unless DEBUG is on.
+    global _debug_q, _debug_thread
+    if _debug_thread is None:
+        _debug_q = queue.SimpleQueue()
+        _debug_thread = threading.Thread(target=_debug_worker, daemon=True)
+        _debug_thread.start()
+        atexit.register(_stop_debug_worker)
+    _debug_q.put_nowait((json_obj, fname))
 
 
 class NtnxRestApiSession:
@@ -41,31 +118,42 @@ class NtnxRestApiSession:
         self.username = username
         self.password = password
         self.v2_url = V2_BASE_URL.format(self.cluster_ip_address)
+        self._urls = {endpoint: self.v2_url + endpoint for endpoint in V2_ENDPOINTS}
         self.session = self.get_server_session()
+        self._verbs = {GET: self.session.get, POST: self.session.post}
 
     def get_server_session(self):
         # Creating REST client session for server connection, after globally setting.
         # Authorization, content type, and character set for the session.
+        # Keep-alive connections are pooled, so only the first call pays the TCP/TLS handshake.
+        urllib3.disable_warnings(InsecureRequestWarning)
         session = requests.Session()
         session.auth = (self.username, self.password)
         session.verify = False
         session.headers.update(
-            {'Content-Type': 'application/json; charset=utf-8'})
+            {'Content-Type': 'application/json; charset=utf-8',
+             'Connection': 'keep-alive'})
+        retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+        session.mount("https://", adapter)
         return session
 
     def rest_call(self, method_type, sub_url, payload_json):
-        if method_type == GET:
-            request_url = self.v2_url + sub_url
-            server_response = self.session.get(request_url)
-        elif method_type == POST:
-            request_url = self.v2_url + sub_url
-            server_response = self.session.post(request_url, payload_json)
-        else:
-            print("method type is wrong!")
-            return
+        verb = self._verbs.get(method_type)
+        if verb is None:
+            raise ValueError("method type is wrong: {}".format(method_type))
+
+        # payload_json is sent as is; pass bytes so requests needs no str->bytes encode
+        # and sets Content-Length from len(payload_json).
+        request_url = self._urls.get(sub_url) or (self.v2_url + sub_url)
+        # Show pending progress messages before blocking on the cluster
+        sys.stdout.flush()
+        server_response = verb(request_url, data=payload_json)
 
         print("Response code: {}".format(server_response.status_code))
-        return server_response.status_code, json.loads(server_response.text)
+
+        # Parse the raw body bytes; decoding to str first is wasted work for a UTF-8 JSON body.
+        return server_response.status_code, _loads(server_response.content)
 
 
 class ClusterModel:
@@ -82,9 +170,10 @@ class ClusterModel:
             rest_status, cluster = self.rest_api.rest_call(GET, "cluster", None)
 
         if DEBUG:
-            output_json(cluster, "cluster.json")
+            debug_json(cluster, "cluster.json")
 
-        self.cluster = cluster.copy()
+        # The model owns the freshly parsed payload, so no defensive copy is needed.
+        self.cluster = cluster
 
     def get_cluster(self):
         return self.cluster
@@ -104,9 +193,10 @@ class ContainerListModel:
             rest_status, containers = self.rest_api.rest_call(GET, "storage_containers", None)
 
         if DEBUG:
-            output_json(containers, "containers.json")
+            debug_json(containers, "containers.json")
 
-        self.containers = containers.get("entities").copy()
+        self.containers = containers["entities"]
+        self.by_name = dict(zip(map(itemgetter("name"), self.containers), self.containers))
 
     def __iter__(self):
         return iter(self.containers)
@@ -126,9 +216,10 @@ class NetworkListModel:
             rest_status, networks = self.rest_api.rest_call(GET, "networks", None)
 
         if DEBUG:
-            output_json(networks, "networks.json")
+            debug_json(networks, "networks.json")
 
-        self.networks = networks.get("entities").copy()
+        self.networks = networks["entities"]
+        self.by_name = dict(zip(map(itemgetter("name"), self.networks), self.networks))
 
     def __iter__(self):
         return iter(self.networks)
@@ -141,8 +232,9 @@ class VmConfigModel:
         self.vm_num_vcpus = vm_num_vcpus
         self.vm_num_cores_per_vcpu = vm_num_cores_per_vcpu
         self.vm_memory_mb = vm_memory_mb
-        self.vm_disks = []
-        self.vm_nics = []
+        # Empty tuples until the first disk/NIC is added, then replaced by a list.
+        self.vm_disks = ()
+        self.vm_nics = ()
 
     def get_vm_name(self):
         return self.vm_name
@@ -163,9 +255,13 @@ class VmConfigModel:
         return iter(self.vm_nics)
 
     def add_disk(self, vm_disk_dto):
+        if isinstance(self.vm_disks, tuple):
+            self.vm_disks = []
         self.vm_disks.append(vm_disk_dto)
 
     def add_nic(self, vm_nic_spec_dto):
+        if isinstance(self.vm_nics, tuple):
+            self.vm_nics = []
         self.vm_nics.append(vm_nic_spec_dto)
 
     def remove_disk(self):
@@ -189,10 +285,11 @@ class VmConfigModel:
         print("\nCreating a VM on the cluster {}".format(self.rest_api.cluster_ip_address))
 
         if DEBUG:
-            output_json(vm_config_dto, "vm_config_dto.json")
+            debug_json(vm_config_dto, "vm_config_dto.json")
 
         if not NO_CONN:
-            rest_status, vms = self.rest_api.rest_call(POST, "vms", json.dumps(vm_config_dto))
+            body = _dumps(vm_config_dto)
+            rest_status, vms = self.rest_api.rest_call(POST, "vms", body)
 
             if vms:
                 print("Task Id: {}".format(vms.get("task_uuid")) + "is scheduled")
@@ -224,11 +321,12 @@ class ContainerListController:
         self.containers = ContainerListModel(self.rest_api)
 
         # Print containers list
-        for i, container in enumerate(self.containers):
-            print("Container #{}".format(i) + ":")
-            print("\tContainerUuid: {}".format(container.get("storage_container_uuid")))
-            print("\tName: {}".format(container.get("name")))
-            print("\tCapacity: {}".format(container.get("max_capacity")))
+        lines = [f"Container #{i}:\n"
+                 f"\tContainerUuid: {container.get('storage_container_uuid')}\n"
+                 f"\tName: {container.get('name')}\n"
+                 f"\tCapacity: {container.get('max_capacity')}\n"
+                 for i, container in enumerate(self.containers)]
+        sys.stdout.write("".join(lines))
 
     def print_container(self, container_uuid):
         # Print a specific container information
@@ -244,11 +342,12 @@ class NetworkListController:
         self.networks = NetworkListModel(self.rest_api)
 
         # Print networks list
-        for i, network in enumerate(self.networks):
-            print("Network #{}".format(i) + ":")
-            print("\tVLAN ID: {}".format(network.get("vlan_id")))
-            print("\tName: {}".format(network.get("name")))
-            print("\tNetworkUuid: {}".format(network.get("uuid")))
+        lines = [f"Network #{i}:\n"
+                 f"\tVLAN ID: {network.get('vlan_id')}\n"
+                 f"\tName: {network.get('name')}\n"
+                 f"\tNetworkUuid: {network.get('uuid')}\n"
+                 for i, network in enumerate(self.networks)]
+        sys.stdout.write("".join(lines))
 
     def print_network(self, vlan_id):
         # Print a specific network(VLAN) information
@@ -271,9 +370,7 @@ class VmCreationController:
 
         while True:
             print("Please add DISKs to the VM")
-            response = input("Do you add DISKs? [Y/N]:")
-
-            if response == "Y":
+            if _yn("Do you add DISKs? [Y/N]:"):
                 print("Y")
                 self.add_vm_disk()
                 continue
@@ -282,9 +379,7 @@ class VmCreationController:
 
         while True:
             print("Please add NICs to the VM")
-            response = input("Do you add NICs? [Y/N]:")
-
-            if response == "Y":
+            if _yn("Do you add NICs? [Y/N]:"):
                 print("Y")
                 self.add_vm_nic()
                 continue
@@ -315,8 +410,7 @@ class VmCreationController:
             for key in vm_nic.keys():
                 print("\t\t" + str(key) + ":" + str(vm_nic.get(key)))
 
-        response = input("Is it OK? [Y/N]:")
-        if response == "Y":
+        if _yn("Is it OK? [Y/N]:"):
             print("Y")
             return True
         else:
@@ -335,8 +429,7 @@ class VmCreationController:
             print("Number of cores per vCPU:" + str(vm_num_cores_per_vcpu))
             print("Memory Size(MB):" + str(vm_memory_mb))
 
-            response = input("Is it OK? [Y/N]:")
-            if response == "Y":
+            if _yn("Is it OK? [Y/N]:"):
                 print("Y")
                 break
             else:
@@ -348,11 +441,12 @@ class VmCreationController:
         vm_disk_dto = {}
         vm_disk_address_dto = {}
         vm_disk_create_dto = {}
-        self.containers = ContainerListModel(self.rest_api)
+        if self.containers is None:
+            self.containers = ContainerListModel(self.rest_api)
 
         while True:
             vm_disk_address_dto["device_bus"] = input("Please enter Disk type [SCSI/IDE/PCI]:")
-            if vm_disk_address_dto["device_bus"] not in DISK_TYPE:
+            if vm_disk_address_dto["device_bus"] not in DISK_TYPES:
                 print("Please input [SCSI/IDE/PCI]")
                 continue
 
@@ -366,36 +460,41 @@ class VmCreationController:
             vm_disk_dto["is_scsi_pass_through"] = False
 
             print("Device Bus:" + vm_disk_address_dto["device_bus"])
-            response = input("Is it OK? [Y/N]:")
-
-            if response == "Y":
+            if _yn("Is it OK? [Y/N]:"):
                 break
             else:
                 continue
 
         # Make user to select ContainerUuid from the list of Container
+        containers_dict = self.containers.by_name
         while True:
             if vm_disk_address_dto["device_bus"] == "IDE":
                 break
             else:
                 print("Select a container from following containers' list")
                 print("#" * 79)
-                containers_dict = {}
-
-                for container in self.containers:
-                    containers_dict[container["name"]] = container
 
                 for container_name in containers_dict.keys():
                     print(container_name)
 
                 container_name = input("Please enter a Container Name for placing the VM:")
                 disk_size = input("Please enter the size(GB) of disk:")
-                container_confirm = input(container_name + " (" + disk_size + " GB)? [Y/N]:")
-                if container_confirm == "Y":
+                try:
+                    disk_size_gb = int(disk_size)
+                except ValueError:
+                    disk_size_gb = 0
+                # The size in bytes must be positive and fit the signed int64 size field of the v2 API
+                if disk_size_gb <= 0 or disk_size_gb << 30 >= 1 << 63:
+                    print(disk_size + " is not right!!!")
+                    continue
+                if _yn(container_name + " (" + disk_size + " GB)? [Y/N]:"):
+                    container = containers_dict.get(container_name)
+                    if container is None:
+                        print(container_name + " is not right!!!")
+                        continue
                     print(container_name + " is selected")
-                    vm_disk_create_dto["storage_container_uuid"] = \
-                        containers_dict[container_name].get("storage_container_uuid")
-                    vm_disk_create_dto["size"] = int(disk_size) * 1024 * 1024 * 1024
+                    vm_disk_create_dto["storage_container_uuid"] = container.get("storage_container_uuid")
+                    vm_disk_create_dto["size"] = disk_size_gb << 30  # GiB to bytes
                     break
                 else:
                     continue
@@ -405,32 +504,29 @@ class VmCreationController:
         if vm_disk_address_dto["device_bus"] != "IDE":
             vm_disk_dto["vm_disk_create"] = vm_disk_create_dto
 
-        if vm_disk_dto:
-            self.vm_config_dto.add_disk(vm_disk_dto)
+        self.vm_config_dto.add_disk(vm_disk_dto)
 
     def add_vm_nic(self):
         vm_nic_spec_dto = {}
-        self.networks = NetworkListModel(self.rest_api)
+        if self.networks is None:
+            self.networks = NetworkListModel(self.rest_api)
 
         # Make user to select NetworkUuid from the list of Network
+        networks_dict = self.networks.by_name
         while True:
             print("Select a network from following networks' list")
             print("#" * 79)
-            networks_dict = {}
-
-            for network in self.networks:
-                networks_dict[network["name"]] = network
 
             for network_name in networks_dict.keys():
                 display_net_address = str(networks_dict[network_name].get("ip_config").get("network_address"))
                 print(network_name + ":" + display_net_address)
 
             network_name = input("Please enter a Network Name for placing VM:")
-            network_confirm = input(network_name + "? [Y/N]:")
-            if network_confirm == "Y":
-                if network_name in networks_dict:
+            if _yn(network_name + "? [Y/N]:"):
+                network = networks_dict.get(network_name)
+                if network is not None:
                     print(network_name + " is selected")
-                    vm_nic_spec_dto["uuid"] = networks_dict[network_name].get("uuid")
+                    vm_nic_spec_dto["uuid"] = network.get("uuid")
                     break
                 else:
                     print(network_name + " is not right!!!")
@@ -440,11 +536,9 @@ class VmCreationController:
 
         while True:
             vm_nic_spec_dto["request_ip"] = False
-            network_confirm = input("Do you want to request IP address?[Y/N]:")
-            if network_confirm == "Y":
+            if _yn("Do you want to request IP address?[Y/N]:"):
                 request_ip_address = input("Please enter request IP address(xxx.xxx.xxx.xxx):")
-                ip_address_confirm = input("IP Address: " + request_ip_address + "\nIs it OK? [Y/N]:")
-                if ip_address_confirm == "Y":
+                if _yn("IP Address: " + request_ip_address + "\nIs it OK? [Y/N]:"):
                     vm_nic_spec_dto["requested_ip_address"] = request_ip_address
                     vm_nic_spec_dto["request_ip"] = True
                     break
@@ -453,11 +547,19 @@ class VmCreationController:
             else:
                 break
 
-        if vm_nic_spec_dto:
-            self.vm_config_dto.add_nic(vm_nic_spec_dto)
+        self.vm_config_dto.add_nic(vm_nic_spec_dto)
 
 
 class MainMenu:
+    # Menu operations; the controller is only constructed for the selected entry.
+    _MENU = {
+        "1": lambda rest_api: ClusterController(rest_api).print_cluster(),
+        "2": lambda rest_api: ContainerListController(rest_api).list_containers(),
+        "3": lambda rest_api: NetworkListController(rest_api).list_networks(),
+        "4": lambda rest_api: print("Not Implemented!"),
+        "5": lambda rest_api: VmCreationController(rest_api).create_vm(),
+    }
+
     def __init__(self):
         print("Welcome to NTNX Cluster Handler Menu")
         tgt_cluster_ip = input("Please enter the Cluster Virtual IP Address\n")
@@ -483,31 +585,24 @@ class MainMenu:
                 print("#" * 79)
                 response = input("Please enter cluster operation\n")
 
-                if response == "99":
+                action = self._MENU.get(response)
+                if action:
+                    action(self.rest_api)
+                elif response == "99":
                     print("NTNX Cluster Handler Exit")
                     break
-                elif response == "1":
-                    ClusterController(self.rest_api).print_cluster()
-                    continue
-                elif response == "2":
-                    ContainerListController(self.rest_api).list_containers()
-                    continue
-                elif response == "3":
-                    NetworkListController(self.rest_api).list_networks()
-                    continue
-                elif response == "4":
-                    print("Not Implemented!")
-                    continue
-                elif response == "5":
-                    VmCreationController(self.rest_api).create_vm()
-                    continue
                 else:
                     print("Wrong Operation: " + response)
-                    continue
 
         except Exception as ex:
             print(ex)
             exit(1)
 
 if __name__ == "__main__":
+    # Block-buffer stdout so the many small prints coalesce into fewer writes.
+    # input() and rest_call flush stdout before blocking, so prompts and progress still show up in time.
+    sys.stdout.flush()
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding=sys.stdout.encoding, errors=sys.stdout.errors,
+                                  line_buffering=False, write_through=False)
+    atexit.register(sys.stdout.flush)
     MainMenu().main_loop()